@@ -1,97 +1,307 @@
 from argparse import ArgumentParser
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from enum import IntEnum
 import asyncio
+import hashlib
+import math
+import os
 import socket
 import random
+import struct
 import sys
 
-def parse_address(addr_str: str) -> tuple[str, int]:
-    host, port = addr_str.split(':')
-    info = socket.getaddrinfo(host, int(port), family=socket.AF_INET)[0]
-    return info[4][0], info[4][1]
-
-def format_address(addr: tuple[str, int]) -> str:
-    return f"{addr[0]}:{addr[1]}"
-
-def split_entry(entry: str) -> tuple[str, str]:
-    return tuple(entry.split())
-
-async def get_async_input(prompt: str = "") -> str:
-    return await asyncio.to_thread(input, prompt)
-
-def log(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    print(*args, **kwargs)
-
-async def key_prompt():
-    return await get_async_input("Digite a chave a ser buscada\n")
-
+from utils import (
+    format_address, get_async_input, install_event_loop_policy, key_prompt, log, parse_address, set_nodelay,
+    split_entry
+)
+
+# numba (with numpy) is optional; it only speeds up bulk statistics replays
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    numba = None
+
+DEBUG = __debug__ and bool(os.environ.get('P2P_DEBUG'))
+SEEN_RESET_INTERVAL = 600
+BP_SEEN_MAX = 10_000
+READ_CHUNK_SIZE = 65536
+MAX_PACKET_SIZE = 512
+REPLY_LIMIT = 4096
+SOCKET_BUFFER_SIZE = 65536
+WRITE_HIGH_WATER = 65536
+ACK_TIMEOUT = 5.0
+INBOX_SIZE = 1024
+INBOX_WORKERS = 8
+OPERATIONS = {b'HELLO', b'SEARCH', b'VAL', b'BYE'}
+
+# Opt-in binary framing: magic byte, body length, origin ip/port, seqno, ttl, op code
+BINARY_FRAMES = bool(os.environ.get('P2P_BINARY'))
+FRAME_MAGIC = b'\x00'
+FRAME_HEADER = struct.Struct('!cH4sHIHB')
+SEARCH_BODY = struct.Struct('!BHH')
+MODE_FL, MODE_RW, MODE_BP = 0, 1, 2
+MODE_CODES = {'FL': MODE_FL, 'RW': MODE_RW, 'BP': MODE_BP}
+MODE_NAMES = {code: name for name, code in MODE_CODES.items()}
+
+def is_valid_packet(data: bytes) -> bool:
+    if len(data) > MAX_PACKET_SIZE:
+        return False
+    if data[:1] == FRAME_MAGIC:
+        if len(data) < FRAME_HEADER.size or data[FRAME_HEADER.size - 1] not in REQUEST_OPS:
+            return False
+        body_size = len(data) - FRAME_HEADER.size
+        if int.from_bytes(data[1:3], 'big') != body_size:
+            return False
+        if data[FRAME_HEADER.size - 1] == Op.SEARCH:
+            return body_size >= SEARCH_BODY.size and data[FRAME_HEADER.size] in MODE_NAMES
+        return True
+    parts = data.split(None, 4)
+    return len(parts) >= 4 and parts[3].upper() in OPERATIONS
+
+def split_frames(buffer: bytes) -> tuple[list[bytes], bytes]:
+    frames = []
+    start = 0
+    while start < len(buffer):
+        if buffer[start:start + 1] == FRAME_MAGIC:
+            if len(buffer) - start < FRAME_HEADER.size:
+                break
+            end = start + FRAME_HEADER.size + int.from_bytes(buffer[start + 1:start + 3], 'big')
+            if end > len(buffer):
+                break
+            frames.append(buffer[start:end])
+            start = end
+        else:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
+            frames.append(buffer[start:end])
+            start = end + 1
+    return frames, buffer[start:]
+
+def set_buffer_sizes(writer: asyncio.StreamWriter, size: int = SOCKET_BUFFER_SIZE):
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+class Op(IntEnum):
+    HELLO = 0
+    SEARCH = 1
+    VAL = 2
+    BYE = 3
+    # Each *_OK reply sits REPLY_OFFSET after its request
+    HELLO_OK = 4
+    SEARCH_OK = 5
+    VAL_OK = 6
+    BYE_OK = 7
+
+    @property
+    def reply_op(self) -> 'Op':
+        return Op(self + REPLY_OFFSET)
+
+REPLY_OFFSET = 4
+REQUEST_OPS = frozenset({Op.HELLO, Op.SEARCH, Op.VAL, Op.BYE})
+
+@dataclass(slots=True)
 class Packet:
-    def __init__(self, msg: str, sender: str | None = None):
-        self.sender = sender
+    origin: tuple[str, int]
+    seqno: int
+    ttl: int
+    op: Op
+    args: list[str] = field(default_factory=list)
+    sender: str | None = None
+    _origin_u64: int = field(init=False, repr=False, compare=False)
+    _uid: tuple[int, int, Op, str] | None = field(default=None, init=False, repr=False, compare=False)
+    _str: str | None = field(default=None, init=False, repr=False, compare=False)
+    _wire: bytes | None = field(default=None, init=False, repr=False, compare=False)
+    _frame: bytes | None = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        host, port = self.origin
+        self._origin_u64 = (int.from_bytes(socket.inet_aton(host), 'big') << 16) | port
+
+    @classmethod
+    def parse(cls, msg: str, sender: str | None = None) -> 'Packet':
         parts = msg.split()
-        self.origin = parse_address(parts[0])
-        self.seqno = int(parts[1])
-        self.ttl = int(parts[2])
-        self.operation = parts[3].upper()
-        self.args = parts[4:]
+        return cls(parse_address(parts[0]), int(parts[1]), int(parts[2]), Op[parts[3].upper()], parts[4:], sender)
+
+    @property
+    def operation(self) -> str:
+        return self.op.name
+
+    @classmethod
+    def from_bytes(cls, view: memoryview, sender: str | None = None) -> 'Packet':
+        _, _, ip, port, seqno, ttl, op_code = FRAME_HEADER.unpack_from(view)
+        op = Op(op_code)
+        body = view[FRAME_HEADER.size:]
+        if op is Op.SEARCH:
+            mode, last_hop_port, hop_count = SEARCH_BODY.unpack_from(body)
+            key = bytes(body[SEARCH_BODY.size:]).decode()
+            args = [MODE_NAMES[mode], str(last_hop_port), key, str(hop_count)]
+        else:
+            args = bytes(body).decode().split()
+        return cls((socket.inet_ntoa(ip), port), seqno, ttl, op, args, sender)
+
+    def to_bytes(self) -> bytes:
+        # Packed once and reused by every neighbour in a fan-out, like to_wire
+        if self._frame is None:
+            try:
+                if self.op is Op.SEARCH:
+                    mode, last_hop_port, key, hop_count = self.args
+                    body = SEARCH_BODY.pack(MODE_CODES[mode], int(last_hop_port), int(hop_count)) + key.encode()
+                else:
+                    body = ' '.join(self.args).encode()
+                host, port = self.origin
+                header = FRAME_HEADER.pack(FRAME_MAGIC, len(body), socket.inet_aton(host), port, self.seqno, self.ttl, self.op)
+                self._frame = header + body
+            except (struct.error, KeyError, ValueError, OSError):
+                # Fields too large for the fixed-width header (e.g. TTL > 65535): send the text form instead
+                self._frame = self.to_wire()
+        return self._frame
 
     def __str__(self) -> str:
-        return ' '.join([format_address(self.origin), str(self.seqno), str(self.ttl), self.operation] + self.args)
+        if self._str is None:
+            self._str = ' '.join([format_address(self.origin), str(self.seqno), str(self.ttl), self.operation] + self.args)
+        return self._str
+
+    def to_wire(self) -> bytes:
+        if self._wire is None:
+            host, port = self.origin
+            fields = [b'%s:%d' % (host.encode(), port), b'%d' % self.seqno, b'%d' % self.ttl, self.operation.encode()]
+            self._wire = b' '.join(fields + [arg.encode() for arg in self.args]) + b'\n'
+        return self._wire
 
     def reply(self) -> str:
-        return f"{format_address(self.origin)} {self.seqno} 1 {self.operation}_OK"
+        return f"{format_address(self.origin)} {self.seqno} 1 {self.op.reply_op.name}"
 
-    def get_unique_id(self) -> tuple[str, int, str]:
-        op_key = f"{self.operation}_{self.args[0]}" if self.operation == "SEARCH" else self.operation
-        return format_address(self.origin), self.seqno, op_key
+    def get_unique_id(self) -> tuple[int, int, Op, str]:
+        if self._uid is None:
+            mode = sys.intern(self.args[0]) if self.op is Op.SEARCH else ''
+            self._uid = self._origin_u64, self.seqno, self.op, mode
+        return self._uid
 
     def forward_search(self, new_hop: tuple[str, int]) -> 'Packet':
         mode, _, key, hop_count = self.args
-        new_hop_count = int(hop_count) + 1
-        return Packet(f"{format_address(self.origin)} {self.seqno} {self.ttl - 1} {self.operation} {mode} {new_hop[1]} {key} {new_hop_count}")
+        return replace(self, ttl=self.ttl - 1, args=[mode, str(new_hop[1]), key, str(int(hop_count) + 1)], sender=None)
 
     def should_discard(self) -> bool:
         if self.ttl <= 0:
-            print("TTL igual a zero, descartando mensagem")
+            if DEBUG:
+                print("TTL igual a zero, descartando mensagem")
             return True
         return False
 
+class BloomFilter:
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.01):
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item) -> list[int]:
+        digest = hashlib.blake2b(repr(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little')
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, item) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def contains_and_add(self, item) -> bool:
+        found = True
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                found = False
+                self.bits[pos >> 3] |= mask
+        return found
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+
+    def schedule_reset(self, interval: float):
+        def reset():
+            self.clear()
+            loop.call_later(interval, reset)
+        loop = asyncio.get_running_loop()
+        loop.call_later(interval, reset)
+
+def welford_batch(state, values):
+    count, mean, m2 = state[0], state[1], state[2]
+    for value in values:
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+    state[0], state[1], state[2] = count, mean, m2
+
+if numba is not None:
+    welford_batch_jit = numba.njit(cache=True)(welford_batch)
+
 class Statistics:
-    def __init__(self):
-        self.counters = {'fl': 0, 'rw': 0, 'bp': 0}
-        self.metrics = {
-            'fl': {'sum': 0, 'sum_sq': 0, 'count': 0},
-            'rw': {'sum': 0, 'sum_sq': 0, 'count': 0},
-            'bp': {'sum': 0, 'sum_sq': 0, 'count': 0}
-        }
+    METRIC_INDEX = {'fl': 0, 'rw': 1, 'bp': 2}
 
-    def increment_counter(self, counter_type: str):
-        self.counters[counter_type] += 1
+    def __init__(self):
+        # Seen-message counters indexed by MODE_FL/MODE_RW/MODE_BP
+        self.counters = [0, 0, 0]
+        # One [count, mean, M2] row per search mode (Welford's online algorithm)
+        self.metrics = [[0, 0.0, 0.0] for _ in self.METRIC_INDEX]
 
     def add_metric(self, metric_type: str, value: int):
-        self.metrics[metric_type]['sum'] += value
-        self.metrics[metric_type]['sum_sq'] += value ** 2
-        self.metrics[metric_type]['count'] += 1
+        m = self.metrics[self.METRIC_INDEX[metric_type]]
+        m[0] += 1
+        delta = value - m[1]
+        m[1] += delta / m[0]
+        m[2] += delta * (value - m[1])
+
+    def add_metrics_bulk(self, metric_type: str, values):
+        m = self.metrics[self.METRIC_INDEX[metric_type]]
+        if numba is None:
+            welford_batch(m, values)
+            return
+        state = np.array(m, dtype=np.float64)
+        welford_batch_jit(state, np.asarray(values, dtype=np.float64))
+        m[:] = [int(state[0]), float(state[1]), float(state[2])]
 
     def calculate_stats(self, metric_type: str) -> str:
-        m = self.metrics[metric_type]
-        if m['count'] == 0:
+        count, avg, m2 = self.metrics[self.METRIC_INDEX[metric_type]]
+        if count == 0:
             return "N/A"
-        avg = m['sum'] / m['count']
-        variance = (m['sum_sq'] / m['count']) - (avg ** 2)
-        std_dev = variance ** 0.5
+        std_dev = (m2 / count) ** 0.5
         return f"{avg:.3} (dp {std_dev:.3})"
 
 class Node:
     def __init__(self, address: str, neighbours_file: str = None, keys_file: str = None):
         self.address = parse_address(address)
+        self._addr_str = format_address(self.address)
+        self._port_str = str(self.address[1])
         self.neighbours = []
+        self._neighbour_set = set()
         self.keys = {}
         self.seqno = 1
         self.default_ttl = 100
-        self.seen = set()
+        self.seen = BloomFilter()
+        # Depth-first search needs exact first-sight checks, so it gets a bounded LRU instead
+        self.bp_seen: OrderedDict[tuple, None] = OrderedDict()
+        self.conns: dict[tuple[str, int], tuple[asyncio.StreamReader, asyncio.StreamWriter, asyncio.Lock]] = {}
         self.stats = Statistics()
-        self.search_state = {'parent': None, 'candidates': [], 'active': None}
+        self.search_state = self.new_search_state(None)
+        # Acked packets wait here for a worker; a full inbox stops reading until workers catch up
+        self.inbox: asyncio.Queue[Packet] = asyncio.Queue(maxsize=INBOX_SIZE)
+        # Inbound connection handlers, so shutdown can end them on EOF instead of cancelling them
+        self.clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        # Indexed by int(Op); *_OK replies never reach process_packet's handlers
+        self._handlers_by_int = [self.process_hello, self.process_search, self.process_values, self.process_bye]
+        self._search_handlers = {
+            'FL': self.process_flooding_search,
+            'RW': self.process_random_walk_search,
+            'BP': self.process_depth_first_search
+        }
 
     def get_next_seqno(self) -> int:
         self.seqno += 1
@@ -99,142 +309,228 @@ class Node:
 
     async def load_neighbours(self, file_path: str):
         with open(file_path, 'r') as file:
-            origin = format_address(self.address)
-            hello_msg = Packet(f"{origin} {self.get_next_seqno()} 1 HELLO")
-            for line in file:
-                neighbour = parse_address(line.strip())
-                print(f"Tentando adicionar vizinho {format_address(neighbour)}")
-                if await self.send_packet(neighbour, hello_msg):
-                    print(f"\tAdicionando vizinho na tabela: {format_address(neighbour)}")
-                    self.neighbours.append(neighbour)
+            hello_msg = Packet(self.address, self.get_next_seqno(), 1, Op.HELLO)
+            candidates = [parse_address(line.strip()) for line in file]
+        for neighbour in candidates:
+            print(f"Tentando adicionar vizinho {format_address(neighbour)}")
+        results = await asyncio.gather(*(self.send_packet(n, hello_msg) for n in candidates), return_exceptions=True)
+        for neighbour, ok in zip(candidates, results):
+            if ok is True:
+                print(f"\tAdicionando vizinho na tabela: {format_address(neighbour)}")
+                self.add_neighbour(neighbour)
 
     async def load_keys(self, file_path: str):
         with open(file_path, 'r') as file:
             for line in file:
                 key, value = split_entry(line)
+                if not key:
+                    continue
                 print(f"Adicionando par ({key}, {value}) na tabela local")
                 self.keys[key] = value
 
-    def has_key(self, key: str) -> bool:
-        if key in self.keys:
+    def add_neighbour(self, neighbour: tuple[str, int]) -> bool:
+        if neighbour in self._neighbour_set:
+            return False
+        self._neighbour_set.add(neighbour)
+        self.neighbours.append(neighbour)
+        return True
+
+    def remove_neighbour(self, neighbour: tuple[str, int]) -> bool:
+        if neighbour not in self._neighbour_set:
+            return False
+        self._neighbour_set.discard(neighbour)
+        self.neighbours.remove(neighbour)
+        return True
+
+    def find_key(self, key: str) -> str | None:
+        value = self.keys.get(key)
+        if value is not None:
             print("Chave encontrada!")
-            return True
-        return False
+        return value
 
     def get_local_key(self, key: str) -> bool:
-        if self.has_key(key):
+        value = self.find_key(key)
+        if value is not None:
             print("Valor na tabela local!")
-            print(f"\tchave: {key} valor: {self.keys[key]}")
+            print(f"\tchave: {key} valor: {value}")
             return True
         return False
 
+    def mark_bp_seen(self, uid: tuple):
+        self.bp_seen[uid] = None
+        self.bp_seen.move_to_end(uid)
+        if len(self.bp_seen) > BP_SEEN_MAX:
+            self.bp_seen.popitem(last=False)
+
+    def new_search_state(self, parent: tuple[str, int] | None) -> dict:
+        # Each search walks its own snapshot of the table, so BYEs cannot shift it mid-search
+        return {'parent': parent, 'candidates': list(self.neighbours), 'visited': set(), 'active': None}
+
     def remove_candidate(self, candidate: tuple[str, int]):
-        if candidate in self.search_state['candidates']:
-            self.search_state['candidates'].remove(candidate)
+        self.search_state['visited'].add(candidate)
+
+    def has_candidates(self) -> bool:
+        candidates = self.search_state['candidates']
+        visited = self.search_state['visited']
+        while candidates and (candidates[-1] in visited or candidates[-1] not in self._neighbour_set):
+            candidates.pop()
+        return bool(candidates)
+
+    def pop_candidate(self) -> tuple[str, int] | None:
+        if not self.has_candidates():
+            return None
+        candidate = self.search_state['candidates'].pop()
+        self.search_state['visited'].add(candidate)
+        return candidate
 
     async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        data = await reader.readline()
+        set_nodelay(writer)
         addr = writer.get_extra_info("peername")[0]
-        packet = Packet(data.decode(), addr)
-
-        print(f"Mensagem recebida: \"{packet}\"")
-        asyncio.create_task(self.process_packet(packet))
+        pending = b''
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                lines, pending = split_frames(pending + chunk)
+                if len(pending) > MAX_PACKET_SIZE:
+                    log(f"Pacote muito grande recebido de {addr}, fechando conexão")
+                    break
+                packets = []
+                valid = True
+                for data in lines:
+                    if not data.strip():
+                        continue
+                    try:
+                        if not is_valid_packet(data):
+                            raise ValueError(data)
+                        if data[:1] == FRAME_MAGIC:
+                            packet = Packet.from_bytes(memoryview(data), addr)
+                        else:
+                            packet = Packet.parse(data.decode(), addr)
+                    except (ValueError, KeyError, OSError, struct.error):
+                        # Packets already parsed from this read are still acked below
+                        log(f"Pacote inválido recebido de {addr}, fechando conexão")
+                        valid = False
+                        break
+                    if DEBUG:
+                        print(f"Mensagem recebida: \"{packet}\"")
+                    packets.append(packet)
+                if packets:
+                    writer.write(b''.join(packet.reply().encode() + b'\n' for packet in packets))
+                    await writer.drain()
+                    for packet in packets:
+                        await self.inbox.put(packet)
+                if not valid:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(task, None)
+            writer.close()
 
-        writer.write(packet.reply().encode())
-        await writer.drain()
+    async def close_clients(self):
+        clients = list(self.clients.items())
+        for _, writer in clients:
+            writer.close()
+        if clients:
+            # A handler stuck on a full inbox is left to asyncio.run's cancellation
+            await asyncio.wait([task for task, _ in clients], timeout=ACK_TIMEOUT)
 
-        writer.close()
-        await writer.wait_closed()
+    async def worker(self):
+        while True:
+            packet = await self.inbox.get()
+            try:
+                await self.process_packet(packet)
+            except Exception as e:
+                log(f"Erro ao processar \"{packet}\": {e!r}")
+            finally:
+                self.inbox.task_done()
 
     async def process_packet(self, packet: Packet):
-        handlers = {
-            "HELLO": self.process_hello,
-            "SEARCH": {
-                "FL": self.process_flooding_search,
-                "RW": self.process_random_walk_search,
-                "BP": self.process_depth_first_search
-            },
-            "VAL": self.process_values,
-            "BYE": self.process_bye
-        }
-        
-        if packet.operation in handlers:
-            if packet.operation == "SEARCH":
-                await handlers[packet.operation][packet.args[0]](packet)
-            else:
-                await handlers[packet.operation](packet)
+        if packet.op < len(self._handlers_by_int):
+            await self._handlers_by_int[packet.op](packet)
         else:
             log(f"Unknown operation: \"{packet.operation}\"")
 
+    async def process_search(self, packet: Packet):
+        await self._search_handlers[packet.args[0]](packet)
+
     async def process_hello(self, packet: Packet):
-        if packet.origin in self.neighbours:
-            print(f"\tVizinho {format_address(packet.origin)} já está na tabela")
-        else:
-            self.neighbours.append(packet.origin)
+        if self.add_neighbour(packet.origin):
             print(f"\tAdicionando vizinho na tabela: {format_address(packet.origin)}")
+        else:
+            print(f"\tVizinho {format_address(packet.origin)} já está na tabela")
 
     async def process_flooding_search(self, packet: Packet):
         mode, last_hop_port, key, hop_count = packet.args
         last_hop = packet.sender, int(last_hop_port)
-        if packet.get_unique_id() in self.seen:
-            print("Flooding: Mensagem repetida!")
+        if self.seen.contains_and_add(packet.get_unique_id()):
+            if DEBUG:
+                print("Flooding: Mensagem repetida!")
             return
-        self.seen.add(packet.get_unique_id())
-        self.stats.increment_counter('fl')
-        if self.has_key(key):
-            reply = Packet(f"{format_address(self.address)} {self.get_next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        self.stats.counters[MODE_FL] += 1
+        value = self.find_key(key)
+        if value is not None:
+            reply = Packet(self.address, self.get_next_seqno(), 1, Op.VAL, [mode, key, value, str(int(hop_count))])
             await self.send_packet(packet.origin, reply)
             return
         forward = packet.forward_search(self.address)
         if forward.should_discard():
             return
-        for neighbour in self.neighbours:
-            if neighbour != last_hop:
-                await self.send_packet(neighbour, forward)
+        await asyncio.gather(*(self.send_packet(n, forward) for n in self.neighbours if n != last_hop), return_exceptions=True)
 
     async def process_random_walk_search(self, packet: Packet):
         mode, last_hop_port, key, hop_count = packet.args
         last_hop = packet.sender, int(last_hop_port)
-        self.seen.add(packet.get_unique_id())
-        self.stats.increment_counter('rw')
-        if self.has_key(key):
-            reply = Packet(f"{format_address(self.address)} {self.get_next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        self.stats.counters[MODE_RW] += 1
+        value = self.find_key(key)
+        if value is not None:
+            reply = Packet(self.address, self.get_next_seqno(), 1, Op.VAL, [mode, key, value, str(int(hop_count))])
             await self.send_packet(packet.origin, reply)
             return
         forward = packet.forward_search(self.address)
         if forward.should_discard():
             return
-        available_neighbours = [n for n in self.neighbours if n != last_hop]
-        next_hop = random.choice(available_neighbours) if available_neighbours else last_hop
+        next_hop = last_hop
+        if len(self.neighbours) > 1 or (self.neighbours and self.neighbours[0] != last_hop):
+            while next_hop == last_hop:
+                next_hop = random.choice(self.neighbours)
         await self.send_packet(next_hop, forward)
 
     async def process_depth_first_search(self, packet: Packet):
         mode, last_hop_port, key, hop_count = packet.args
         last_hop = packet.sender, int(last_hop_port)
-        self.stats.increment_counter('bp')
-        if self.has_key(key):
-            reply = Packet(f"{format_address(self.address)} {self.get_next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        self.stats.counters[MODE_BP] += 1
+        value = self.find_key(key)
+        if value is not None:
+            reply = Packet(self.address, self.get_next_seqno(), 1, Op.VAL, [mode, key, value, str(int(hop_count))])
             await self.send_packet(packet.origin, reply)
             return
         forward = packet.forward_search(self.address)
         if forward.should_discard():
             return
-        if packet.get_unique_id() not in self.seen:
-            log(f"\033[33mMensagem {packet.get_unique_id()} ainda vista\033[m")
-            self.search_state = {'parent': last_hop, 'candidates': list(self.neighbours), 'active': None}
+        if packet.get_unique_id() not in self.bp_seen:
+            if DEBUG:
+                log(f"\033[33mMensagem {packet.get_unique_id()} ainda vista\033[m")
+            self.search_state = self.new_search_state(last_hop)
         self.remove_candidate(last_hop)
-        self.seen.add(packet.get_unique_id())
-        if self.search_state['parent'] == self.address and self.search_state['active'] == last_hop and not self.search_state['candidates']:
+        self.mark_bp_seen(packet.get_unique_id())
+        if self.search_state['parent'] == self.address and self.search_state['active'] == last_hop and not self.has_candidates():
             print(f"BP: Nao foi possivel localizar a chave {key}")
             return
         if self.search_state['active'] is not None and self.search_state['active'] != last_hop:
-            print("BP: ciclo detectado, devolvendo a mensagem...")
+            if DEBUG:
+                print("BP: ciclo detectado, devolvendo a mensagem...")
             await self.send_packet(last_hop, forward)
-        elif not self.search_state['candidates']:
-            print("BP: nenhum vizinho encontrou a chave, retrocedendo...")
+        elif not self.has_candidates():
+            if DEBUG:
+                print("BP: nenhum vizinho encontrou a chave, retrocedendo...")
             await self.send_packet(self.search_state['parent'], forward)
         else:
-            self.search_state['active'] = self.search_state['candidates'].pop()
+            self.search_state['active'] = self.pop_candidate()
             await self.send_packet(self.search_state['active'], forward)
 
     async def process_values(self, packet: Packet):
@@ -244,15 +540,20 @@ class Node:
         self.stats.add_metric(mode.lower(), int(hop_count))
 
     async def process_bye(self, packet: Packet):
-        if packet.origin in self.neighbours:
-            self.neighbours.remove(packet.origin)
+        if self.remove_neighbour(packet.origin):
             print(f"\tRemovendo vizinho da tabela: {format_address(packet.origin)}")
 
     async def start_server(self):
         addr, port = self.address
-        server = await asyncio.start_server(self.handle_connection, addr, port)
-        async with server:
-            await server.serve_forever()
+        self.seen.schedule_reset(SEEN_RESET_INTERVAL)
+        workers = [asyncio.create_task(self.worker()) for _ in range(INBOX_WORKERS)]
+        server = await asyncio.start_server(self.handle_connection, addr, port, start_serving=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
 
     async def run_menu(self):
         menu_options = {
@@ -300,8 +601,7 @@ class Node:
         index = int(await get_async_input())
         if 0 <= index < len(self.neighbours):
             address = self.neighbours[index]
-            origin = format_address(self.address)
-            message = Packet(f"{origin} {self.get_next_seqno()} 1 HELLO")
+            message = Packet(self.address, self.get_next_seqno(), 1, Op.HELLO)
             await self.send_packet(address, message)
         else:
             log("Erro! Vizinho inválido")
@@ -310,21 +610,15 @@ class Node:
         key = await key_prompt()
         if self.get_local_key(key):
             return
-        origin = format_address(self.address)
-        port = self.address[1]
-        message = Packet(f"{origin} {self.get_next_seqno()} {self.default_ttl} SEARCH FL {port} {key} 1")
+        message = Packet(self.address, self.get_next_seqno(), self.default_ttl, Op.SEARCH, ["FL", self._port_str, key, "1"])
         self.seen.add(message.get_unique_id())
-        for neighbour in self.neighbours:
-            await self.send_packet(neighbour, message)
+        await asyncio.gather(*(self.send_packet(n, message) for n in self.neighbours), return_exceptions=True)
 
     async def new_random_walk_search(self):
         key = await key_prompt()
         if self.get_local_key(key):
             return
-        origin = format_address(self.address)
-        port = self.address[1]
-        message = Packet(f"{origin} {self.get_next_seqno()} {self.default_ttl} SEARCH RW {port} {key} 1")
-        self.seen.add(message.get_unique_id())
+        message = Packet(self.address, self.get_next_seqno(), self.default_ttl, Op.SEARCH, ["RW", self._port_str, key, "1"])
         neighbour = random.choice(self.neighbours)
         await self.send_packet(neighbour, message)
 
@@ -332,19 +626,20 @@ class Node:
         key = await key_prompt()
         if self.get_local_key(key):
             return
-        origin = format_address(self.address)
-        port = self.address[1]
-        message = Packet(f"{origin} {self.get_next_seqno()} {self.default_ttl} SEARCH BP {port} {key} 1")
-        self.seen.add(message.get_unique_id())
-        self.search_state = {'parent': self.address, 'candidates': list(self.neighbours), 'active': None}
-        self.search_state['active'] = self.search_state['candidates'].pop()
+        message = Packet(self.address, self.get_next_seqno(), self.default_ttl, Op.SEARCH, ["BP", self._port_str, key, "1"])
+        self.mark_bp_seen(message.get_unique_id())
+        self.search_state = self.new_search_state(self.address)
+        self.search_state['active'] = self.pop_candidate()
+        if self.search_state['active'] is None:
+            print(f"BP: Nao foi possivel localizar a chave {key}")
+            return
         await self.send_packet(self.search_state['active'], message)
 
     async def show_statistics(self):
         print("Estatísticas:") 
-        print(f"\tTotal de mensagens de flooding vistas: {self.stats.counters['fl']}")
-        print(f"\tTotal de mensagens de random walk vistas: {self.stats.counters['rw']}")
-        print(f"\tTotal de mensagens de busca em profundidade vistas: {self.stats.counters['bp']}")
+        print(f"\tTotal de mensagens de flooding vistas: {self.stats.counters[MODE_FL]}")
+        print(f"\tTotal de mensagens de random walk vistas: {self.stats.counters[MODE_RW]}")
+        print(f"\tTotal de mensagens de busca em profundidade vistas: {self.stats.counters[MODE_BP]}")
         print(f"\tMédia de saltos até encontrar destino por flooding: {self.stats.calculate_stats('fl')}")
         print(f"\tMédia de saltos até encontrar destino por random walk: {self.stats.calculate_stats('rw')}")
         print(f"\tMédia de saltos até encontrar destino por busca em profundidade: {self.stats.calculate_stats('bp')}")
@@ -357,31 +652,72 @@ class Node:
             log("Erro! TTL deve ser maior que 0")
 
     async def send_bye(self):
-        origin = format_address(self.address)
-        message = Packet(f"{origin} {self.get_next_seqno()} 1 BYE")
-        for neighbour in self.neighbours:
-            await self.send_packet(neighbour, message)
-
-    async def send_packet(self, address: tuple[str, int], packet: Packet) -> bool:
-        addr, port = address
-        print(f"Encaminhando mensagem \"{packet}\" para {format_address(address)}")
-        try:
-            reader, writer = await asyncio.open_connection(addr, port)
-            writer.write(f"{packet}\n".encode())
-            await writer.drain()
-
-            data = await reader.read(100)
-            reply = data.decode().strip()
-
+        message = Packet(self.address, self.get_next_seqno(), 1, Op.BYE)
+        await asyncio.gather(*(self.send_packet(n, message) for n in self.neighbours), return_exceptions=True)
+        await self.close_connections()
+
+    async def get_connection(self, address: tuple[str, int]) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, asyncio.Lock]:
+        conn = self.conns.get(address)
+        if conn is None or conn[1].is_closing():
+            reader, writer = await asyncio.open_connection(*address, limit=REPLY_LIMIT)
+            current = self.conns.get(address)
+            if current is not None and not current[1].is_closing():
+                # Another sender connected while this one was waiting
+                writer.close()
+                return current
+            set_nodelay(writer)
+            set_buffer_sizes(writer)
+            conn = self.conns[address] = reader, writer, asyncio.Lock()
+        return conn
+
+    def drop_connection(self, address: tuple[str, int]):
+        conn = self.conns.pop(address, None)
+        if conn is not None:
+            conn[1].close()
+
+    async def close_connections(self):
+        conns = list(self.conns.values())
+        self.conns.clear()
+        for _, writer, _ in conns:
             writer.close()
-            await writer.wait_closed()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
 
-            reply_packet = Packet(reply, addr)
-            if reply_packet.operation == f"{packet.operation}_OK":
-                print(f"\tEnvio feito com sucesso: \"{packet}\"")
+    async def send_packet(self, address: tuple[str, int], packet: Packet) -> bool:
+        if DEBUG:
+            print(f"Encaminhando mensagem \"{packet}\" para {format_address(address)}")
+        for _ in range(2):
+            reused = address in self.conns
+            try:
+                reader, writer, lock = await self.get_connection(address)
+                async with lock:
+                    writer.write(packet.to_bytes() if BINARY_FRAMES else packet.to_wire())
+                    if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                        await writer.drain()
+                    try:
+                        data = await asyncio.wait_for(reader.readuntil(b'\n'), ACK_TIMEOUT)
+                    except asyncio.IncompleteReadError as e:
+                        data = e.partial
+            except asyncio.TimeoutError:
+                # Unresponsive peer: give up on it rather than wait on a retry as well
+                self.drop_connection(address)
+                break
+            except (OSError, asyncio.LimitOverrunError):
+                data = b''
+            if not data:
+                # Peer closed the pooled connection; reconnect once
+                self.drop_connection(address)
+                if reused:
+                    continue
+                break
+            parts = data.split(None, 4)
+            if len(parts) >= 4 and parts[3].upper() == packet.op.reply_op.name.encode():
+                if DEBUG:
+                    print(f"\tEnvio feito com sucesso: \"{packet}\"")
                 return True
-        except ConnectionRefusedError:
-            pass
+            break
         print("\tErro ao conectar!")
         return False
 
@@ -397,7 +733,7 @@ async def main() -> int:
     address, neighbours, keys = parse_args()
     node = Node(address, neighbours, keys)
     asyncio.create_task(node.start_server())
-    print(f"Servidor criado: {format_address(node.address)}")
+    print(f"Servidor criado: {node._addr_str}")
 
     print()
 
@@ -410,7 +746,9 @@ async def main() -> int:
         await node.load_keys(keys)
 
     await node.run_menu()
+    await node.close_clients()
     return 0
 
 if __name__ == "__main__":
+    install_event_loop_policy()
     sys.exit(asyncio.run(main()))
@@ -1,70 +1,122 @@
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
 import asyncio
+import logging
+import logging.handlers
+import os
+import queue
 import socket
 import random
 import sys
 
-def adress_split(address: str) -> tuple[str, int]:
-    addr, port = address.split(':')
-    entries = socket.getaddrinfo(addr, int(port), family=socket.AF_INET)
-    first_entry = entries[0]
-    host, port = first_entry[4][0], first_entry[4][1]
-    return host, port
+from utils import (
+    format_address, get_async_input, install_event_loop_policy, key_prompt, log, parse_address, set_nodelay,
+    split_entry
+)
 
-def adress_string(address: tuple[str, int]) -> str:
-    addr, port = address
-    return f"{addr}:{port}"
+logger = logging.getLogger(__name__)
 
-def entry_split(key_val: str) -> tuple[str, str]:
-    return key_val.split()
+SEEN_MAX = 100_000
+WRITE_HIGH_WATER = 65536
+ACK_TIMEOUT = 5.0
+INBOX_SIZE = 1024
+INBOX_WORKERS = 8
 
-async def async_input(prompt: str = "") -> str:
-    return await asyncio.to_thread(input, prompt)
-
-def debug_print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    print(*args, **kwargs)
-
-async def key_prompt():
-    return await async_input("Digite a chave a ser buscada\n")
+# Message ids pack seqno, origin ip, origin port and an operation code into one int
+MessageId = int
+OP_CODES = {"HELLO": 0, "VAL": 1, "BYE": 2, ("SEARCH", "FL"): 3, ("SEARCH", "RW"): 4, ("SEARCH", "BP"): 5}
+UNKNOWN_OP_CODE = 7
 
 class Message:
+    __slots__ = ("sender", "seqno", "ttl", "operation", "args", "_origin", "_origin_str", "_uid", "_str", "_wire")
+
     sender: str | None
-    origin: tuple[str, int]
     seqno: int
     ttl: int
     operation: str
     args: list[str]
+    _origin: tuple[str, int] | None
+    _origin_str: str
+    _uid: MessageId | None
+    _str: str | None
+    _wire: bytes | None
 
     def __init__(self, message: str, sender: str | None = None):
         self.sender = sender
-        [origin, seqno, ttl, operation, *args] = message.split()
-        self.origin = adress_split(origin)
-        self.seqno = int(seqno)
-        self.ttl = int(ttl)
-        self.operation = operation.upper()
-        self.args = args
+        parts = message.split(None, 4)
+        self._origin = None
+        self._origin_str = parts[0]
+        self.seqno = int(parts[1])
+        self.ttl = int(parts[2])
+        self.operation = parts[3].upper()
+        self.args = parts[4].split() if len(parts) > 4 else []
+        self._uid = None
+        self._str = None
+        self._wire = None
+
+    @classmethod
+    def build(cls, origin: tuple[str, int] | None, seqno: int, ttl: int, operation: str, args: list[str] = (),
+              origin_str: str | None = None) -> 'Message':
+        message = cls.__new__(cls)
+        message.sender = None
+        message._origin = origin
+        message._origin_str = origin_str if origin_str is not None else format_address(origin)
+        message.seqno = seqno
+        message.ttl = ttl
+        message.operation = operation
+        message.args = list(args)
+        message._uid = None
+        message._str = None
+        message._wire = None
+        return message
+
+    @property
+    def origin(self) -> tuple[str, int]:
+        # Resolved on first use instead of on every parse
+        if self._origin is None:
+            self._origin = parse_address(self._origin_str)
+        return self._origin
 
     def __str__(self) -> str:
-        msg = f"{adress_string(self.origin)} {self.seqno} {self.ttl} {self.operation}"
-        return ' '.join([msg, *self.args])
+        if self._str is None:
+            msg = f"{self._origin_str} {self.seqno} {self.ttl} {self.operation}"
+            self._str = ' '.join([msg, *self.args])
+        return self._str
 
-    def reply(self) -> str:
-        return f"{adress_string(self.origin)} {self.seqno} 1 {self.operation}_OK"
-
-    def tuple_unique(self) -> tuple[str, int, str]:
-        op_key = f"{self.operation}_{self.args[0]}" if self.operation == "SEARCH" else self.operation
-        return adress_string(self.origin), self.seqno, op_key
+    def to_wire(self) -> bytes:
+        # Encoded once and shared by every send of this message
+        if self._wire is None:
+            self._wire = f"{self}\n".encode()
+        return self._wire
 
-    def fw_search(self, new_last_hop_ip: tuple[str, int]) -> 'Message':
+    def reply(self) -> str:
+        return f"{self._origin_str} {self.seqno} 1 {self.operation}_OK"
+
+    @property
+    def op_key(self) -> str | tuple[str, str]:
+        # Searches are told apart by their mode, everything else by the operation alone
+        if self.operation == "SEARCH" and self.args:
+            return self.operation, self.args[0]
+        return self.operation
+
+    def unique_id(self) -> MessageId:
+        if self._uid is None:
+            host, port = self.origin
+            ip = int.from_bytes(socket.inet_aton(host), 'big')
+            self._uid = (self.seqno << 51) | (ip << 19) | (port << 3) | OP_CODES.get(self.op_key, UNKNOWN_OP_CODE)
+        return self._uid
+
+    def fw_search(self, last_hop_port: str) -> 'Message':
         mode, _, key, hop_count = self.args
-        last_hop_port = new_last_hop_ip[1]
         hop_count = int(hop_count) + 1
-        return Message(f"{adress_string(self.origin)} {self.seqno} {self.ttl - 1} {self.operation} {mode} {last_hop_port} {key} {hop_count}")
+        # Reuse the origin token as received; the forwarded copy never needs it resolved
+        return Message.build(self._origin, self.seqno, self.ttl - 1, self.operation,
+                             [mode, last_hop_port, key, str(hop_count)], origin_str=self._origin_str)
 
     def discard_msg_ttl(self) -> bool:
         if self.ttl <= 0:
-            print("TTL igual a zero, descartando mensagem")
+            logger.debug("TTL igual a zero, descartando mensagem")
             return True
         return False
 
@@ -72,250 +124,312 @@ class Stats:
     fl_count: int
     rw_count: int
     bp_count: int
-    fl_avg_hops: float
-    fl_avgsqr_hops: float
-    fl_val_count: int
-    rw_avg_hops: float
-    rw_avgsqr_hops: float
-    rw_val_count: int
-    bp_avg_hops: float
-    bp_avgsqr_hops: float
-    bp_val_count: int
+    hops: dict[str, list[int]]
 
     def __init__(self):
         self.fl_count = 0
         self.rw_count = 0
         self.bp_count = 0
-        self.fl_avg_hops = 0
-        self.fl_avgsqr_hops = 0
-        self.fl_val_count = 0
-        self.rw_avg_hops = 0
-        self.rw_avgsqr_hops = 0
-        self.rw_val_count = 0
-        self.bp_avg_hops = 0
-        self.bp_avgsqr_hops = 0
-        self.bp_val_count = 0
-
-    def record_value(self, hops: int, avg_hops_attr, avgsqr_hops_attr, val_count_attr):
-        setattr(self, avg_hops_attr, getattr(self, avg_hops_attr) + hops)
-        setattr(self, avgsqr_hops_attr, getattr(self, avgsqr_hops_attr) + hops * hops)
-        setattr(self, val_count_attr, getattr(self, val_count_attr) + 1)
-
-    def record_fl_value(self, hops: int):
-        self.record_value(hops, 'fl_avg_hops', 'fl_avgsqr_hops', 'fl_val_count')
-
-    def record_rw_value(self, hops: int):
-        self.record_value(hops, 'rw_avg_hops', 'rw_avgsqr_hops', 'rw_val_count')
-
-    def record_bp_value(self, hops: int):
-        self.record_value(hops, 'bp_avg_hops', 'bp_avgsqr_hops', 'bp_val_count')
-
-    def calculate_stats(self, val_count, avg_hops, avgsqr_hops) -> str:
+        # Per search mode: [sum of hops, sum of squared hops, number of values]
+        self.hops = {'fl': [0, 0, 0], 'rw': [0, 0, 0], 'bp': [0, 0, 0]}
+
+    def record_value(self, mode: str, hops: int):
+        h = self.hops.get(mode)
+        if h is None:
+            return
+        h[0] += hops
+        h[1] += hops * hops
+        h[2] += 1
+
+    def calculate_stats(self, mode: str) -> str:
+        hops_sum, hops_sqr_sum, val_count = self.hops[mode]
         if val_count == 0:
             return "N/A"
-        avg = avg_hops / val_count
-        avgsqr = avgsqr_hops / val_count
-        variance = avgsqr - avg * avg
+        avg = hops_sum / val_count
+        avgsqr = hops_sqr_sum / val_count
+        # Clamp rounding noise: the running-sum form can dip just below zero
+        variance = max(avgsqr - avg * avg, 0.0)
         deviation = variance ** 0.5
         return f"{avg:.3} (dp {deviation:.3})"
 
-    def fl_stats_calc(self) -> str:
-        return self.calculate_stats(self.fl_val_count, self.fl_avg_hops, self.fl_avgsqr_hops)
-
-    def rw_stats_calc(self) -> str:
-        return self.calculate_stats(self.rw_val_count, self.rw_avg_hops, self.rw_avgsqr_hops)
-
-    def bp_stats_calc(self) -> str:
-        return self.calculate_stats(self.bp_val_count, self.bp_avg_hops, self.bp_avgsqr_hops)
-
 
 class Node:
     address: tuple[str, int]
-    neighbours: list[tuple[str, int]]
+    _origin_str: str
+    _port_str: str
+    neighbours: dict[tuple[str, int], None]
+    _neighbour_list: list[tuple[str, int]] | None
     keys: dict[str, str]
     seqno: int
     default_ttl: int
-    seen: set[tuple[str, int, str]]
+    seen: OrderedDict[MessageId, None]
     stats: Stats
     # Depth-first search state:
     parent_node: tuple[str, int] | None
-    candidate_nodes: list[tuple[str, int]]
+    candidate_nodes: dict[tuple[str, int], None]
     active_node: tuple[str, int] | None
+    # Per neighbour: the pooled writer and the acks still awaited on it, keyed by (origin, seqno, op)
+    _conns: dict[tuple[str, int], tuple[asyncio.StreamWriter, deque[tuple[str, asyncio.Future]]]]
+    inbox: asyncio.Queue[Message]
+    _handlers: dict[str | tuple[str, str], Callable[[Message], Awaitable[None]]]
 
     def __init__(self, address: str, neighbours_file: str = None, keys_file: str = None):
-        self.address = adress_split(address)
-        self.neighbours = []
+        self.address = parse_address(address)
+        self._origin_str = format_address(self.address)
+        self._port_str = str(self.address[1])
+        self.neighbours = {}
+        self._neighbour_list = None
         self.keys = {}
         self.seqno = 1
         self.default_ttl = 100
-        self.seen = set()
+        self.seen = OrderedDict()
         self.stats = Stats()
         self.parent_node = None
-        self.candidate_nodes = []
+        self.candidate_nodes = {}
         self.active_node = None
+        self._conns = {}
+        self.clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        # Acked messages wait here for a worker; a full inbox stops reading until workers catch up
+        self.inbox = asyncio.Queue(maxsize=INBOX_SIZE)
+        self._handlers = {
+            "HELLO": self.process_hello,
+            ("SEARCH", "FL"): self.process_flooding_search,
+            ("SEARCH", "RW"): self.process_random_walk_search,
+            ("SEARCH", "BP"): self.process_depth_first_search,
+            "VAL": self.process_values,
+            "BYE": self.process_bye
+        }
 
     def next_seqno(self) -> int:
         self.seqno += 1
         return self.seqno - 1
 
+    def add_neighbour(self, neighbour: tuple[str, int]):
+        self.neighbours[neighbour] = None
+        self._neighbour_list = None
+
+    def remove_neighbour(self, neighbour: tuple[str, int]) -> bool:
+        if neighbour not in self.neighbours:
+            return False
+        del self.neighbours[neighbour]
+        self._neighbour_list = None
+        return True
+
+    def neighbour_list(self) -> list[tuple[str, int]]:
+        # Indexable snapshot for random picks, rebuilt only after the table changes
+        if self._neighbour_list is None:
+            self._neighbour_list = list(self.neighbours)
+        return self._neighbour_list
+
+    def new_message(self, ttl: int, operation: str, args: list[str] = ()) -> Message:
+        return Message.build(self.address, self.next_seqno(), ttl, operation, args, origin_str=self._origin_str)
+
     async def load_neighbours(self, neighbours_file: str):
         with open(neighbours_file, 'r') as file:
-            origin = adress_string(self.address)
-            message = Message(f"{origin} {self.next_seqno()} 1 HELLO")
-            for line in file.readlines():
-                address = adress_split(line.strip())
-                print(f"Tentando adicionar vizinho {adress_string(address)}")
-                sent_successfully = await self.send_msg(address, message)
-                if sent_successfully:
-                    print(f"\tAdicionando vizinho na tabela: {adress_string(address)}")
-                    self.neighbours.append(address)
+            message = self.new_message(1, "HELLO")
+            candidates = [parse_address(line.strip()) for line in file]
+        for address in candidates:
+            print(f"Tentando adicionar vizinho {format_address(address)}")
+        results = await asyncio.gather(
+            *(self.send_msg(address, message) for address in candidates),
+            return_exceptions=True
+        )
+        for address, sent_successfully in zip(candidates, results):
+            if sent_successfully is True:
+                print(f"\tAdicionando vizinho na tabela: {format_address(address)}")
+                self.add_neighbour(address)
 
     async def load_keys(self, keys_file: str):
         with open(keys_file, 'r') as file:
-            for line in file.readlines():
-                key, value = entry_split(line)
+            for line in file:
+                key, value = split_entry(line)
+                if not key:
+                    continue
                 print(f"Adicionando par ({key}, {value}) na tabela local")
                 self.keys[key] = value
 
-    def key_found(self, key: str) -> bool:
-        if key in self.keys:
+    def key_found(self, key: str) -> str | None:
+        value = self.keys.get(key)
+        if value is not None:
             print("Chave encontrada!")
-            return True
-        return False
+        return value
 
     def local_key(self, key: str) -> bool:
-        if self.key_found(key):
+        value = self.key_found(key)
+        if value is not None:
             print("Valor na tabela local!")
-            print(f"\tchave: {key} valor: {self.keys[key]}")
+            print(f"\tchave: {key} valor: {value}")
             return True
         return False
 
+    def mark_seen(self, uid: MessageId):
+        self.seen[uid] = None
+        self.seen.move_to_end(uid)
+        if len(self.seen) > SEEN_MAX:
+            self.seen.popitem(last=False)
+
     def delete_candidate(self, candidate: tuple[str, int]):
-        try:
-            self.candidate_nodes.remove(candidate)
-        except ValueError:
-            pass
+        self.candidate_nodes.pop(candidate, None)
 
     async def process_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        data = await reader.readline()
+        set_nodelay(writer)
         addr: str = writer.get_extra_info("peername")[0]
-        message = Message(data.decode(), addr)
-
-        print(f"Mensagem recebida: \"{message}\"")
-        asyncio.create_task(self.process_msg(message))
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        # Pooled peers keep the connection open and send many messages over it
+        try:
+            while data := await reader.readline():
+                if not data.strip():
+                    continue
+                try:
+                    message = Message(data.decode(), addr)
+                except (ValueError, IndexError):
+                    # Skip the bad line; later messages on this connection are still served
+                    log(f"Mensagem inválida recebida de {addr}: {data!r}")
+                    continue
+
+                logger.debug("Mensagem recebida: \"%s\"", message)
+
+                writer.write(f"{message.reply()}\n".encode())
+                if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    await writer.drain()
+
+                await self.inbox.put(message)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(task, None)
+            writer.close()
 
-        writer.write(message.reply().encode())
-        await writer.drain()
+    async def close_clients(self):
+        clients = list(self.clients.items())
+        for _, writer in clients:
+            writer.close()
+        if clients:
+            # A handler stuck on a full inbox is left to asyncio.run's cancellation
+            await asyncio.wait([task for task, _ in clients], timeout=ACK_TIMEOUT)
 
-        writer.close()
-        await writer.wait_closed()
+    async def worker(self):
+        while True:
+            message = await self.inbox.get()
+            try:
+                await self.process_msg(message)
+            except Exception as e:
+                log(f"Erro ao processar \"{message}\": {e!r}")
+            finally:
+                self.inbox.task_done()
 
     async def process_msg(self, message: Message):
-        match message.operation, *message.args:
-            case ("HELLO",): await self.process_hello(message)
-            case ("SEARCH", "FL", *_): await self.process_flooding_search(message)
-            case ("SEARCH", "RW", *_): await self.process_random_walk_search(message)
-            case ("SEARCH", "BP", *_): await self.process_depth_first_search(message)
-            case ("VAL", *_): await self.process_values(message)
-            case ("BYE",): await self.process_bye(message)
-            case op: debug_print(f"Unknown operation: \"{' '.join(op)}\"")
+        handler = self._handlers.get(message.op_key)
+        if handler is None:
+            log(f"Unknown operation: \"{' '.join([message.operation, *message.args])}\"")
+            return
+        await handler(message)
 
     async def process_hello(self, message: Message):
         if message.origin in self.neighbours:
-            print(f"\tVizinho {adress_string(message.origin)} já está na tabela")
+            print(f"\tVizinho {format_address(message.origin)} já está na tabela")
         else:
-            self.neighbours.append(message.origin)
-            print(f"\tAdicionando vizinho na tabela: {adress_string(message.origin)}")
+            self.add_neighbour(message.origin)
+            print(f"\tAdicionando vizinho na tabela: {format_address(message.origin)}")
 
     async def process_flooding_search(self, message: Message):
         mode, last_hop_port, key, hop_count = message.args
         last_hop_ip = message.sender, int(last_hop_port)
-        if message.tuple_unique() in self.seen:
-            print("Flooding: Mensagem repetida!")
+        if message.unique_id() in self.seen:
+            logger.debug("Flooding: Mensagem repetida!")
             return
-        self.seen.add(message.tuple_unique())
+        self.mark_seen(message.unique_id())
         self.stats.fl_count += 1
-        if self.key_found(key):
-            reply = Message(f"{adress_string(self.address)} {self.next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        value = self.key_found(key)
+        if value is not None:
+            reply = self.new_message(1, "VAL", [mode, key, value, str(int(hop_count))])
             await self.send_msg(message.origin, reply)
             return
-        reply = message.fw_search(self.address)
+        reply = message.fw_search(self._port_str)
         if reply.discard_msg_ttl():
             return
-        for neighbour in self.neighbours:
-            if neighbour == last_hop_ip:
-                continue
-            await self.send_msg(neighbour, reply)
+        await asyncio.gather(
+            *(self.send_msg(neighbour, reply) for neighbour in self.neighbours if neighbour != last_hop_ip),
+            return_exceptions=True
+        )
 
     async def process_random_walk_search(self, message: Message):
         mode, last_hop_port, key, hop_count = message.args
         last_hop_ip = message.sender, int(last_hop_port)
-        self.seen.add(message.tuple_unique())
+        self.mark_seen(message.unique_id())
         self.stats.rw_count += 1
-        if self.key_found(key):
-            reply = Message(f"{adress_string(self.address)} {self.next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        value = self.key_found(key)
+        if value is not None:
+            reply = self.new_message(1, "VAL", [mode, key, value, str(int(hop_count))])
             await self.send_msg(message.origin, reply)
             return
-        reply = message.fw_search(self.address)
+        reply = message.fw_search(self._port_str)
         if reply.discard_msg_ttl():
             return
-        neighbours = [*self.neighbours]
-        neighbours.remove(last_hop_ip)
-        neighbour = random.choice(neighbours) if neighbours else last_hop_ip
+        neighbours = self.neighbour_list()
+        if not neighbours or (len(neighbours) == 1 and neighbours[0] == last_hop_ip):
+            neighbour = last_hop_ip
+        else:
+            # Rejection-sample instead of copying the table without the last hop
+            neighbour = random.choice(neighbours)
+            while neighbour == last_hop_ip:
+                neighbour = random.choice(neighbours)
         await self.send_msg(neighbour, reply)
 
     async def process_depth_first_search(self, message: Message):
         mode, last_hop_port, key, hop_count = message.args
         last_hop_ip = message.sender, int(last_hop_port)
         self.stats.bp_count += 1
-        if self.key_found(key):
-            reply = Message(f"{adress_string(self.address)} {self.next_seqno()} 1 VAL {mode} {key} {self.keys[key]} {int(hop_count)}")
+        value = self.key_found(key)
+        if value is not None:
+            reply = self.new_message(1, "VAL", [mode, key, value, str(int(hop_count))])
             await self.send_msg(message.origin, reply)
             return
-        reply = message.fw_search(self.address)
+        reply = message.fw_search(self._port_str)
         if reply.discard_msg_ttl():
             return
-        if message.tuple_unique() not in self.seen:
-            debug_print(f"\033[33mMensagem {message.tuple_unique()} ainda vista\033[m")
+        if message.unique_id() not in self.seen:
+            logger.debug("\033[33mMensagem \"%s\" ainda vista\033[m", message)
             self.parent_node = last_hop_ip
-            self.candidate_nodes = [*self.neighbours]
+            self.candidate_nodes = dict.fromkeys(self.neighbours)
             self.active_node = None
         self.delete_candidate(last_hop_ip)
-        self.seen.add(message.tuple_unique())
+        self.mark_seen(message.unique_id())
         if self.parent_node == self.address and self.active_node == last_hop_ip and not self.candidate_nodes:
             print(f"BP: Nao foi possivel localizar a chave {key}")
             return
         if self.active_node is not None and self.active_node != last_hop_ip:
-            print("BP: ciclo detectado, devolvendo a mensagem...")
+            logger.debug("BP: ciclo detectado, devolvendo a mensagem...")
             await self.send_msg(last_hop_ip, reply)
         elif not self.candidate_nodes:
-            print("BP: nenhum vizinho encontrou a chave, retrocedendo...")
+            logger.debug("BP: nenhum vizinho encontrou a chave, retrocedendo...")
             await self.send_msg(self.parent_node, reply)
         else:
-            self.active_node = self.candidate_nodes.pop()
+            self.active_node, _ = self.candidate_nodes.popitem()
             await self.send_msg(self.active_node, reply)
 
     async def process_values(self, message: Message):
         mode, key, value, hop_count = message.args
         print("\tValor encontrado!")
         print(f"\t\tChave: {key} valor: {value}")
-        match mode:
-            case "FL": self.stats.record_fl_value(int(hop_count))
-            case "RW": self.stats.record_rw_value(int(hop_count))
-            case "BP": self.stats.record_bp_value(int(hop_count))
+        self.stats.record_value(mode.lower(), int(hop_count))
 
     async def process_bye(self, message: Message):
-        try:
-            self.neighbours.remove(message.origin)
-            print(f"\tRemovendo vizinho da tabela: {adress_string(message.origin)}")
-        except ValueError:
-            pass
+        if self.remove_neighbour(message.origin):
+            self.close_connection(message.origin)
+            print(f"\tRemovendo vizinho da tabela: {format_address(message.origin)}")
 
     async def initiate_server(self):
         addr, port = self.address
+        workers = [asyncio.create_task(self.worker()) for _ in range(INBOX_WORKERS)]
         server = await asyncio.start_server(self.process_client_connection, addr, port)
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
 
     async def display_menu(self):
         while True:
@@ -331,7 +445,7 @@ class Node:
                 "\t[6] Alterar valor padrao de TTL\n"
                 "\t[9] Sair"
             )
-            option = (await async_input()).strip()
+            option = (await get_async_input()).strip()
             match option:
                 case '0': await self.list_of_neighbours()
                 case '1': await self.send_hello()
@@ -341,62 +455,57 @@ class Node:
                 case '5': await self.show_statistics()
                 case '6': await self.change_default_ttl()
                 case '9': break
-                case _: debug_print("Erro! Opção inválida")
+                case _: log("Erro! Opção inválida")
         await self.send_bye()
 
     async def list_of_neighbours(self):
         print(f"\nHá {len(self.neighbours)} vizinhos na tabela:")
         for index, neighbour in enumerate(self.neighbours):
-            print(f"\t[{index}] {adress_string(neighbour)}")
+            print(f"\t[{index}] {format_address(neighbour)}")
 
     async def send_hello(self):
         if not self.neighbours:
-            debug_print("Erro! Não há vizinhos")
+            log("Erro! Não há vizinhos")
             return
         print("\nEscolha o vizinho:")
         await self.list_of_neighbours()
-        neighbour = int(await async_input())
+        neighbour = int(await get_async_input())
         if neighbour < 0 or neighbour >= len(self.neighbours):
-            debug_print("Erro! Vizinho inválido")
+            log("Erro! Vizinho inválido")
             return
-        address = self.neighbours[neighbour]
-        origin = adress_string(self.address)
-        message = Message(f"{origin} {self.next_seqno()} 1 HELLO")
+        address = self.neighbour_list()[neighbour]
+        message = self.new_message(1, "HELLO")
         await self.send_msg(address, message)
 
     async def new_flooding_search(self):
         key = await key_prompt()
         if self.local_key(key):
             return
-        origin = adress_string(self.address)
-        port = self.address[1]
-        message = Message(f"{origin} {self.next_seqno()} {self.default_ttl} SEARCH FL {port} {key} 1")
-        self.seen.add(message.tuple_unique())
-        for neighbour in self.neighbours:
-            await self.send_msg(neighbour, message)
+        message = self.new_message(self.default_ttl, "SEARCH", ["FL", self._port_str, key, "1"])
+        self.mark_seen(message.unique_id())
+        await asyncio.gather(
+            *(self.send_msg(neighbour, message) for neighbour in self.neighbours),
+            return_exceptions=True
+        )
 
     async def new_random_walk_search(self):
         key = await key_prompt()
         if self.local_key(key):
             return
-        origin = adress_string(self.address)
-        port = self.address[1]
-        message = Message(f"{origin} {self.next_seqno()} {self.default_ttl} SEARCH RW {port} {key} 1")
-        self.seen.add(message.tuple_unique())
-        neighbour = random.choice(self.neighbours)
+        message = self.new_message(self.default_ttl, "SEARCH", ["RW", self._port_str, key, "1"])
+        self.mark_seen(message.unique_id())
+        neighbour = random.choice(self.neighbour_list())
         await self.send_msg(neighbour, message)
 
     async def new_depth_first_search(self):
         key = await key_prompt()
         if self.local_key(key):
             return
-        origin = adress_string(self.address)
-        port = self.address[1]
-        message = Message(f"{origin} {self.next_seqno()} {self.default_ttl} SEARCH BP {port} {key} 1")
-        self.seen.add(message.tuple_unique())
+        message = self.new_message(self.default_ttl, "SEARCH", ["BP", self._port_str, key, "1"])
+        self.mark_seen(message.unique_id())
         self.parent_node = self.address
-        self.candidate_nodes = [*self.neighbours]
-        self.active_node = self.candidate_nodes.pop()
+        self.candidate_nodes = dict.fromkeys(self.neighbours)
+        self.active_node, _ = self.candidate_nodes.popitem()
         await self.send_msg(self.active_node, message)
 
     async def show_statistics(self):
@@ -404,41 +513,115 @@ class Node:
         print(f"\tTotal de mensagens de flooding vistas: {self.stats.fl_count}")
         print(f"\tTotal de mensagens de random walk vistas: {self.stats.rw_count}")
         print(f"\tTotal de mensagens de busca em profundidade vistas: {self.stats.bp_count}")
-        print(f"\tMédia de saltos até encontrar destino por flooding: {self.stats.fl_stats_calc()}")
-        print(f"\tMédia de saltos até encontrar destino por random walk: {self.stats.rw_stats_calc()}")
-        print(f"\tMédia de saltos até encontrar destino por busca em profundidade: {self.stats.bp_stats_calc()}")
+        print(f"\tMédia de saltos até encontrar destino por flooding: {self.stats.calculate_stats('fl')}")
+        print(f"\tMédia de saltos até encontrar destino por random walk: {self.stats.calculate_stats('rw')}")
+        print(f"\tMédia de saltos até encontrar destino por busca em profundidade: {self.stats.calculate_stats('bp')}")
 
     async def change_default_ttl(self):
-        self.default_ttl = int(await async_input("\nDigite novo valor de TTL\n"))
-        if self.default_ttl < 1:
-            debug_print("Erro! TTL deve ser maior que 0")
+        new_ttl = int(await get_async_input("\nDigite novo valor de TTL\n"))
+        if new_ttl < 1:
+            log("Erro! TTL deve ser maior que 0")
+            return
+        self.default_ttl = new_ttl
 
     async def send_bye(self):
-        origin = adress_string(self.address)
-        message = Message(f"{origin} {self.next_seqno()} 1 BYE")
-        for neighbour in self.neighbours:
-            await self.send_msg(neighbour, message)
-
-    async def send_msg(self, address: tuple[str, int], message: Message) -> bool:
-        addr, port = address
-        print(f"Encaminhando mensagem \"{message}\" para {adress_string(address)}")
+        message = self.new_message(1, "BYE")
+        await asyncio.gather(
+            *(self.send_msg(neighbour, message) for neighbour in self.neighbours),
+            return_exceptions=True
+        )
+        await self.close_connections()
+
+    async def get_connection(self, address: tuple[str, int]) -> tuple[asyncio.StreamWriter, deque]:
+        conn = self._conns.get(address)
+        if conn is None or conn[0].is_closing():
+            reader, writer = await asyncio.open_connection(*address)
+            current = self._conns.get(address)
+            if current is not None and not current[0].is_closing():
+                # Another sender connected while this one was waiting
+                writer.close()
+                return current
+            set_nodelay(writer)
+            conn = self._conns[address] = writer, deque()
+            asyncio.create_task(self.read_replies(address, reader, conn))
+        return conn
+
+    async def read_replies(self, address: tuple[str, int], reader: asyncio.StreamReader, conn: tuple):
+        _, pending = conn
         try:
-            reader, writer = await asyncio.open_connection(addr, port)
-            writer.write(f"{message}\n".encode())
-            await writer.drain()
-
-            data = await reader.read(100)
-            reply = data.decode().strip()
-
+            while True:
+                try:
+                    data = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    data = e.partial
+                if not data:
+                    break
+                parts = data.decode().split()
+                if len(parts) < 4:
+                    continue
+                if not pending:
+                    continue
+                # Replies arrive in request order, so each one answers the oldest request
+                op, future = pending.popleft()
+                if not future.done():
+                    future.set_result(parts[3].upper() == op)
+        except (OSError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if self._conns.get(address) is conn:
+                self.close_connection(address)
+            for _, future in pending:
+                if not future.done():
+                    future.set_result(None)
+            pending.clear()
+
+    def close_connection(self, address: tuple[str, int]):
+        conn = self._conns.pop(address, None)
+        if conn is not None:
+            conn[0].close()
+
+    async def close_connections(self):
+        writers = [writer for writer, _ in self._conns.values()]
+        self._conns.clear()
+        for writer in writers:
             writer.close()
-            await writer.wait_closed()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
 
-            reply_msg = Message(reply, addr)
-            if reply_msg.operation == f"{message.operation}_OK":
-                print(f"\tEnvio feito com sucesso: \"{message}\"")
+    async def send_msg(self, address: tuple[str, int], message: Message) -> bool:
+        logger.debug("Encaminhando mensagem \"%s\" para %s", message, format_address(address))
+        reply_op = f"{message.operation}_OK"
+        for _ in range(2):
+            reused = address in self._conns
+            conn = None
+            try:
+                conn = writer, pending = await self.get_connection(address)
+                acked = asyncio.get_running_loop().create_future()
+                pending.append((reply_op, acked))
+                writer.write(message.to_wire())
+                if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    await writer.drain()
+                result = await asyncio.wait_for(acked, ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Unresponsive peer: give up on it rather than wait on a retry as well
+                if conn is not None and self._conns.get(address) is conn:
+                    self.close_connection(address)
+                break
+            except OSError:
+                result = None
+            if result is None:
+                # Connection dropped before the ack: retry once if it was a stale pooled one
+                if conn is not None and self._conns.get(address) is conn:
+                    self.close_connection(address)
+                if reused:
+                    continue
+                break
+            if result:
+                logger.debug("\tEnvio feito com sucesso: \"%s\"", message)
                 return True
-        except ConnectionRefusedError:
-            pass
+            break
         print("\tErro ao conectar!")
         return False
 
@@ -459,11 +642,37 @@ def parse_args() -> tuple[str, str, str]:
     args = parser.parse_args()
     return args.address, args.neighbours_file, args.keys_file
 
+class RawQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats on the caller's thread; hand the record over
+    # untouched so the listener thread does the formatting
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def configure_logging() -> logging.handlers.QueueListener:
+    # Records are formatted and written by the listener thread, off the event loop
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    logging.basicConfig(
+        level=logging.DEBUG if os.environ.get('P2P_DEBUG') else logging.INFO,
+        handlers=[RawQueueHandler(records)]
+    )
+    listener.start()
+    return listener
+
 async def main() -> int:
+    listener = configure_logging()
+    try:
+        return await run_node()
+    finally:
+        listener.stop()
+
+async def run_node() -> int:
     address, neighbours, keys = parse_args()
     node = Node(address, neighbours, keys)
     asyncio.create_task(node.initiate_server())
-    print(f"Servidor criado: {adress_string(node.address)}")
+    print(f"Servidor criado: {node._origin_str}")
 
     print()
 
@@ -476,7 +685,9 @@ async def main() -> int:
         await node.load_keys(keys)
 
     await node.display_menu()
+    await node.close_clients()
     return 0
 
 if __name__ == "__main__":
+    install_event_loop_policy()
     sys.exit(asyncio.run(main()))
\ No newline at end of file
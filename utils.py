@@ -0,0 +1,70 @@
+import asyncio
+import functools
+import socket
+import sys
+import threading
+
+@functools.lru_cache(maxsize=4096)
+def parse_address(addr_str: str) -> tuple[str, int]:
+    host, _, port = addr_str.partition(':')
+    try:
+        # Numeric IPv4 needs no resolver round trip
+        socket.inet_pton(socket.AF_INET, host)
+        return host, int(port)
+    except OSError:
+        pass
+    info = socket.getaddrinfo(host, int(port), family=socket.AF_INET)[0]
+    return info[4][0], info[4][1]
+
+@functools.lru_cache(maxsize=4096)
+def format_address(addr: tuple[str, int]) -> str:
+    return f"{addr[0]}:{addr[1]}"
+
+def set_nodelay(writer: asyncio.StreamWriter):
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def split_entry(entry: str) -> tuple[str, str]:
+    key, _, value = entry.strip().partition(' ')
+    return key, value.strip()
+
+_stdin_lines: asyncio.Queue | None = None
+
+def _read_stdin(loop: asyncio.AbstractEventLoop, lines: asyncio.Queue):
+    # One long-lived reader thread instead of a pool thread per prompt; None marks EOF
+    try:
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        loop.call_soon_threadsafe(lines.put_nowait, None)
+    except RuntimeError:
+        pass
+
+async def get_async_input(prompt: str = "") -> str:
+    global _stdin_lines
+    if _stdin_lines is None:
+        _stdin_lines = asyncio.Queue()
+        threading.Thread(target=_read_stdin, args=(asyncio.get_running_loop(), _stdin_lines), daemon=True).start()
+    if prompt:
+        print(prompt, end='', flush=True)
+    line = await _stdin_lines.get()
+    if line is None:
+        _stdin_lines.put_nowait(None)
+        raise EOFError
+    return line.rstrip('\n')
+
+def log(*args, **kwargs):
+    kwargs.setdefault('file', sys.stderr)
+    print(*args, **kwargs)
+
+async def key_prompt():
+    return await get_async_input("Digite a chave a ser buscada\n")
+
+def install_event_loop_policy():
+    # uvloop is an optional dependency (pip install uvloop); fall back to the stock loop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        if sys.platform == 'win32':
+            asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())